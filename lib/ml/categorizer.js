@@ -1,16 +1,20 @@
 /**
- * Motor de Inferência ONNX - Categorização de Transações
+ * Motor de Inferência - Categorização de Transações
  *
- * Carrega modelos ONNX treinados pelo script Python e executa
+ * Carrega modelos treinados pelo script Python e executa
  * classificação em 2 estágios:
  *   1. PJ vs PF (tipo)
  *   2. Categoria específica (condicionada ao tipo)
  *
+ * O treino exporta os pesos lineares (linear_models.json) e a inferência
+ * é um produto esparso direto em JS. Os modelos ONNX só são usados como
+ * fallback para artefatos de treinos antigos, sem linear_models.json.
+ *
  * Modelos são carregados uma vez (cold start ~200ms) e cacheados
  * no module scope para reutilização em warm starts.
  */
 
-import { buildFeatureVector, softmax } from './feature-engineering.js'
+import { buildFeatureVector, buildSparseFeatureVector, softmax } from './feature-engineering.js'
 import path from 'path'
 import fs from 'fs'
 
@@ -24,7 +28,39 @@ let loaded = false
 const MODELS_DIR = path.join(process.cwd(), 'lib', 'ml', 'models', 'categorizer')
 
 /**
- * Carrega modelos ONNX e metadados (executado uma vez por cold start)
+ * Lê um arquivo binário float32 little-endian como Float32Array
+ */
+function readFloat32File(filePath) {
+  const buf = fs.readFileSync(filePath)
+  return new Float32Array(new Uint8Array(buf).buffer)
+}
+
+/**
+ * Carrega os pesos lineares exportados pelo treino (linear_models.json)
+ */
+function loadLinearModels(linearPath) {
+  const meta = JSON.parse(fs.readFileSync(linearPath, 'utf-8'))
+  const models = {}
+
+  for (const [key, m] of Object.entries(meta)) {
+    const weights = readFloat32File(path.join(MODELS_DIR, m.weights_file))
+    if (weights.length !== m.n_features * m.n_outputs) {
+      throw new Error(`${m.weights_file} com ${weights.length} pesos, esperado ${m.n_features * m.n_outputs}`)
+    }
+    models[key] = {
+      linear: true,
+      weights,
+      intercept: Float64Array.from(m.intercept),
+      nOutputs: m.n_outputs,
+      link: m.link
+    }
+  }
+
+  return models
+}
+
+/**
+ * Carrega modelos e metadados (executado uma vez por cold start)
  */
 async function loadModels() {
   if (loaded) return !loadError
@@ -35,8 +71,9 @@ async function loadModels() {
     const vocabPath = path.join(MODELS_DIR, 'vocabulary.json')
     const labelsPath = path.join(MODELS_DIR, 'label_maps.json')
     const tipoPath = path.join(MODELS_DIR, 'categorizer_tipo.onnx')
+    const linearPath = path.join(MODELS_DIR, 'linear_models.json')
 
-    if (!fs.existsSync(vocabPath) || !fs.existsSync(tipoPath)) {
+    if (!fs.existsSync(vocabPath) || (!fs.existsSync(tipoPath) && !fs.existsSync(linearPath))) {
       loadError = 'Modelos ML não encontrados. Execute o treinamento: python scripts/ml/train_categorizer.py'
       console.warn(`[ML] ${loadError}`)
       return false
@@ -46,6 +83,23 @@ async function loadModels() {
     vocabularyCache = JSON.parse(fs.readFileSync(vocabPath, 'utf-8'))
     labelMapsCache = JSON.parse(fs.readFileSync(labelsPath, 'utf-8'))
 
+    // IDF em sidecar binário (float32 little-endian) nos vocabulários novos
+    if (vocabularyCache.idf_file) {
+      vocabularyCache.idf = readFloat32File(path.join(MODELS_DIR, vocabularyCache.idf_file))
+      if (vocabularyCache.idf.length !== vocabularyCache.tfidf_size) {
+        throw new Error(`${vocabularyCache.idf_file} com ${vocabularyCache.idf.length} valores, esperado ${vocabularyCache.tfidf_size}`)
+      }
+    }
+
+    // Pesos lineares: inferência esparsa em JS, sem carregar o onnxruntime
+    if (vocabularyCache.hashing && fs.existsSync(linearPath)) {
+      modelsCache = loadLinearModels(linearPath)
+      if (modelsCache.tipo) {
+        console.log(`[ML] Modelos lineares carregados: ${Object.keys(modelsCache).join(', ')}`)
+        return true
+      }
+    }
+
     // Import dinâmico do onnxruntime-node
     const ort = await import('onnxruntime-node')
 
@@ -103,6 +157,45 @@ async function runInference(session, features) {
   return data
 }
 
+/**
+ * Inferência com pesos lineares sobre features esparsas
+ * scores = intercept + soma(valor * pesos da coluna), só nas colunas não-nulas
+ */
+function runLinearInference(model, sparse) {
+  const { weights, intercept, nOutputs } = model
+  const scores = Float64Array.from(intercept)
+
+  for (let k = 0; k < sparse.indices.length; k++) {
+    const base = sparse.indices[k] * nOutputs
+    const val = sparse.values[k]
+    for (let c = 0; c < nOutputs; c++) {
+      scores[c] += val * weights[base + c]
+    }
+  }
+
+  // Binário: um único score para a classe positiva (segunda do label map)
+  if (model.link === 'logistic') {
+    const p = 1 / (1 + Math.exp(-scores[0]))
+    return [1 - p, p]
+  }
+
+  // One-vs-rest (SGDClassifier): sigmoide por classe, normalizada pela soma
+  if (model.link === 'ovr') {
+    const probs = Array.from(scores, s => 1 / (1 + Math.exp(-s)))
+    const sum = probs.reduce((a, b) => a + b, 0)
+    return sum > 0 ? probs.map(p => p / sum) : probs.map(() => 1 / probs.length)
+  }
+
+  return softmax(Array.from(scores))
+}
+
+/**
+ * Retorna probabilidades por classe, no motor do modelo carregado
+ */
+async function predictProbs(model, features) {
+  return model.linear ? runLinearInference(model, features) : runInference(model, features)
+}
+
 /**
  * Categoriza uma transação usando o modelo ML local
  *
@@ -116,8 +209,9 @@ export async function categorizarML(descricao, valor, banco) {
   if (!ready) return null
 
   try {
-    // Construir vetor de features
-    const features = buildFeatureVector(
+    // Construir vetor de features (esparso para os modelos lineares)
+    const buildFeatures = modelsCache.tipo.linear ? buildSparseFeatureVector : buildFeatureVector
+    const features = buildFeatures(
       descricao,
       valor,
       banco,
@@ -126,7 +220,7 @@ export async function categorizarML(descricao, valor, banco) {
     )
 
     // Estágio 1: PJ vs PF
-    const tipoProbs = await runInference(modelsCache.tipo, features)
+    const tipoProbs = await predictProbs(modelsCache.tipo, features)
     const tipoLabels = labelMapsCache.tipo // ["PF", "PJ"]
     const tipoIdx = tipoProbs.indexOf(Math.max(...tipoProbs))
     const tipo = tipoLabels[tipoIdx]
@@ -141,7 +235,7 @@ export async function categorizarML(descricao, valor, banco) {
     const catLabels = tipo === 'PJ' ? labelMapsCache.pj : labelMapsCache.pf
 
     if (catModel && catLabels && catLabels.length > 0) {
-      const catProbs = await runInference(catModel, features)
+      const catProbs = await predictProbs(catModel, features)
 
       // Top 3 categorias com probabilidades
       const catScores = catLabels.map((label, i) => ({
@@ -214,12 +308,13 @@ export async function getMLInfo() {
 
   return {
     available: true,
+    engine: modelsCache?.tipo?.linear ? 'linear' : 'onnx',
     models: {
       tipo: !!modelsCache?.tipo,
       pj: !!modelsCache?.pj,
       pf: !!modelsCache?.pf
     },
-    vocabularySize: vocabularyCache?.terms?.length || 0,
+    vocabularySize: vocabularyCache?.tfidf_size || vocabularyCache?.terms?.length || 0,
     report
   }
 }
@@ -85,22 +85,147 @@ function computeTF(text, minN = 2, maxN = 4) {
   return counts
 }
 
+/**
+ * Extrai n-gramas de caracteres por palavra (espelha o analyzer "char_wb"
+ * do scikit-learn). Cada palavra recebe padding de espaço e palavras
+ * curtas (menores que n) são contadas uma única vez. Retorna um array
+ * com repetições, para contagem de frequência.
+ */
+export function extractCharWbNgrams(text, minN = 2, maxN = 4) {
+  const ngrams = []
+
+  for (const word of text.split(/\s+/)) {
+    if (!word) continue
+    const w = Array.from(` ${word} `) // code points, como o slicing do Python
+
+    for (let n = minN; n <= maxN; n++) {
+      let offset = 0
+      ngrams.push(w.slice(offset, offset + n).join(''))
+      while (offset + n < w.length) {
+        offset++
+        ngrams.push(w.slice(offset, offset + n).join(''))
+      }
+      if (offset === 0) break // palavra curta: conta só uma vez
+    }
+  }
+
+  return ngrams
+}
+
+const utf8Encoder = new TextEncoder()
+
+/**
+ * MurmurHash3 (x86, 32 bits) sobre os bytes UTF-8 da string
+ * Retorna inteiro com sinal, igual a sklearn.utils.murmurhash3_32
+ */
+export function murmurhash3_32(text, seed = 0) {
+  const bytes = utf8Encoder.encode(text)
+  const len = bytes.length
+  const nblocks = len >> 2
+  const c1 = 0xcc9e2d51
+  const c2 = 0x1b873593
+  let h = seed | 0
+  let k
+
+  for (let i = 0; i < nblocks; i++) {
+    const j = i << 2
+    k = bytes[j] | (bytes[j + 1] << 8) | (bytes[j + 2] << 16) | (bytes[j + 3] << 24)
+    k = Math.imul(k, c1)
+    k = (k << 15) | (k >>> 17)
+    k = Math.imul(k, c2)
+    h ^= k
+    h = (h << 13) | (h >>> 19)
+    h = (Math.imul(h, 5) + 0xe6546b64) | 0
+  }
+
+  const tail = nblocks << 2
+  k = 0
+  switch (len & 3) {
+    case 3: k ^= bytes[tail + 2] << 16 // fallthrough
+    case 2: k ^= bytes[tail + 1] << 8 // fallthrough
+    case 1:
+      k ^= bytes[tail]
+      k = Math.imul(k, c1)
+      k = (k << 15) | (k >>> 17)
+      k = Math.imul(k, c2)
+      h ^= k
+  }
+
+  h ^= len
+  h ^= h >>> 16
+  h = Math.imul(h, 0x85ebca6b)
+  h ^= h >>> 13
+  h = Math.imul(h, 0xc2b2ae35)
+  h ^= h >>> 16
+
+  return h | 0
+}
+
+/**
+ * Índice da coluna no espaço de hashing (espelha HashingVectorizer com
+ * alternate_sign=False)
+ */
+function hashIndex(ngram, nFeatures) {
+  const h = murmurhash3_32(ngram)
+  if (h === -2147483648) return (2147483647 - (nFeatures - 1)) % nFeatures
+  return Math.abs(h) % nFeatures
+}
+
+/**
+ * Calcula o bloco TF-IDF via hashing trick: contagem por n-grama,
+ * multiplicada pelo IDF e normalizada em L2 (espelha HashingVectorizer +
+ * TfidfTransformer do treinamento). Retorna Map<coluna, valor> só com
+ * as colunas não-nulas.
+ */
+function computeHashedTfidf(text, vocabulary) {
+  const { n_features: nFeatures, ngram_range: [minN, maxN] } = vocabulary.hashing
+  const tfidf = new Map()
+
+  for (const ngram of extractCharWbNgrams(text, minN, maxN)) {
+    const idx = hashIndex(ngram, nFeatures)
+    tfidf.set(idx, (tfidf.get(idx) || 0) + 1)
+  }
+
+  let norm = 0
+  for (const [idx, count] of tfidf) {
+    const val = count * vocabulary.idf[idx]
+    tfidf.set(idx, val)
+    norm += val * val
+  }
+
+  if (norm > 0) {
+    norm = Math.sqrt(norm)
+    for (const [idx, val] of tfidf) {
+      tfidf.set(idx, val / norm)
+    }
+  }
+
+  return tfidf
+}
+
+/**
+ * Índice do banco no one-hot (primeiro banco conhecido contido no nome)
+ */
+function findBancoIndex(banco, bancosList) {
+  const bancoNorm = (banco || 'desconhecido').toUpperCase().normalize('NFD').replace(/[\u0300-\u036f]/g, '')
+  return bancosList.findIndex(b => bancoNorm.includes(b.toUpperCase()))
+}
+
 /**
  * Constrói vetor de features para inferência ONNX
  *
  * @param {string} descricao - Descrição da transação
  * @param {number} valor - Valor da transação
  * @param {string} banco - Nome do banco
- * @param {object} vocabulary - { terms: string[], idf: number[] } do treinamento
+ * @param {object} vocabulary - { hashing, idf } (ou { terms, idf } em vocabulários antigos) do treinamento
  * @param {string[]} bancosList - Lista de bancos conhecidos (one-hot encoding)
  * @returns {Float32Array} Vetor de features pronto para o modelo
  */
 export function buildFeatureVector(descricao, valor, banco, vocabulary, bancosList) {
   const normalized = normalizeDescription(descricao)
-  const tf = computeTF(normalized)
 
-  // TF-IDF features (tamanho = vocabulary.terms.length)
-  const tfidfSize = vocabulary.terms.length
+  // TF-IDF features (tamanho = espaço de hashing, ou vocabulary.terms.length)
+  const tfidfSize = vocabulary.hashing ? vocabulary.hashing.n_features : vocabulary.terms.length
   const bancosSize = bancosList.length
   const numericSize = 1 // log(valor)
 
@@ -108,15 +233,22 @@ export function buildFeatureVector(descricao, valor, banco, vocabulary, bancosLi
   const features = new Float32Array(featureSize)
 
   // 1. TF-IDF
-  for (let i = 0; i < vocabulary.terms.length; i++) {
-    const term = vocabulary.terms[i]
-    const tfVal = tf.get(term) || 0
-    features[i] = tfVal * vocabulary.idf[i]
+  if (vocabulary.hashing) {
+    for (const [idx, val] of computeHashedTfidf(normalized, vocabulary)) {
+      features[idx] = val
+    }
+  } else {
+    // Vocabulário explícito (modelos treinados antes do hashing trick)
+    const tf = computeTF(normalized)
+    for (let i = 0; i < vocabulary.terms.length; i++) {
+      const term = vocabulary.terms[i]
+      const tfVal = tf.get(term) || 0
+      features[i] = tfVal * vocabulary.idf[i]
+    }
   }
 
   // 2. Banco (one-hot encoding)
-  const bancoNorm = (banco || 'desconhecido').toUpperCase().normalize('NFD').replace(/[\u0300-\u036f]/g, '')
-  const bancoIdx = bancosList.findIndex(b => bancoNorm.includes(b.toUpperCase()))
+  const bancoIdx = findBancoIndex(banco, bancosList)
   if (bancoIdx >= 0) {
     features[tfidfSize + bancoIdx] = 1.0
   }
@@ -127,6 +259,35 @@ export function buildFeatureVector(descricao, valor, banco, vocabulary, bancosLi
   return features
 }
 
+/**
+ * Constrói o mesmo vetor de features em formato esparso (só não-nulos)
+ * Uma descrição curta tem ~50 n-gramas ativos contra milhares de colunas,
+ * então o produto com os pesos do modelo linear fica O(nnz).
+ * Requer vocabulário com hashing.
+ *
+ * @returns {{ indices: Int32Array, values: Float32Array, size: number }}
+ */
+export function buildSparseFeatureVector(descricao, valor, banco, vocabulary, bancosList) {
+  const normalized = normalizeDescription(descricao)
+  const tfidfSize = vocabulary.hashing.n_features
+  const bancosSize = bancosList.length
+
+  const entries = Array.from(computeHashedTfidf(normalized, vocabulary))
+
+  const bancoIdx = findBancoIndex(banco, bancosList)
+  if (bancoIdx >= 0) {
+    entries.push([tfidfSize + bancoIdx, 1.0])
+  }
+
+  entries.push([tfidfSize + bancosSize, Math.log1p(Math.abs(valor || 0))])
+
+  return {
+    indices: Int32Array.from(entries, e => e[0]),
+    values: Float32Array.from(entries, e => e[1]),
+    size: tfidfSize + bancosSize + 1
+  }
+}
+
 /**
  * Aplica softmax a um array de logits
  * Converte logits em probabilidades (soma = 1)
@@ -11,33 +11,44 @@ Uso:
   2. Instalar dependências: pip install -r requirements.txt
   3. Rodar: python scripts/ml/train_categorizer.py
 
-Os modelos ONNX são salvos em lib/ml/models/categorizer/
+Os pesos lineares (inferência esparsa no JS) são salvos em
+lib/ml/models/categorizer/. Com TRAINING_EXPORT_ONNX=1 os modelos ONNX
+também são exportados, só como fallback legado.
 """
 
+import contextlib
+import hashlib
+import io
 import json
 import os
 import sys
-import unicodedata
+import time
 import re
 from datetime import datetime
 
+import ijson
 import numpy as np
 import pandas as pd
 import requests
-from sklearn.feature_extraction.text import TfidfVectorizer
+from joblib import Parallel, delayed
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
 from sklearn.linear_model import SGDClassifier
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import StratifiedShuffleSplit
 from sklearn.metrics import classification_report, accuracy_score
 from sklearn.pipeline import Pipeline
-from scipy.sparse import hstack, csr_matrix
+from scipy.sparse import hstack, vstack, csr_matrix
 import onnxruntime as ort
 
 try:
     from skl2onnx import convert_sklearn
     from skl2onnx.common.data_types import FloatTensorType
 except ImportError:
-    print("ERRO: skl2onnx não instalado. Execute: pip install skl2onnx")
-    sys.exit(1)
+    convert_sklearn = None  # só necessário com TRAINING_EXPORT_ONNX=1
+
+try:
+    import onnxoptimizer
+except ImportError:
+    onnxoptimizer = None  # opcional: sem ele o grafo é exportado sem fusões
 
 
 # ============================================================
@@ -45,11 +56,25 @@ except ImportError:
 # ============================================================
 API_URL = os.getenv("TRAINING_DATA_URL", "http://localhost:3000/api/ml/training-data")
 OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "lib", "ml", "models", "categorizer")
+CACHE_DIR = os.path.join(os.path.dirname(__file__), ".cache")
+CACHE_TTL_SECONDS = int(os.getenv("TRAINING_CACHE_TTL", "600"))
 MIN_SAMPLES_PER_CLASS = 3
 MIN_TOTAL_SAMPLES = 50
-TFIDF_MAX_FEATURES = 5000
+HASHING_N_FEATURES = 8192
+NGRAM_RANGE = (2, 4)
+IDF_FILENAME = "idf.f32"
+HASHING_CHUNK_SIZE = 10000
 TEST_SIZE = 0.2
 RANDOM_STATE = 42
+EXPORT_ONNX = os.getenv("TRAINING_EXPORT_ONNX", "0") == "1"  # só para o fallback legado do JS
+ONNX_VALIDATION_ROWS = 256
+ONNX_MIN_AGREEMENT = 0.99
+ONNX_MAX_PROB_DIFF = 0.01  # "confianca" é limiar exposto ao usuário
+ONNX_OPTIMIZER_PASSES = ["fuse_matmul_add_bias_into_gemm", "eliminate_deadend"]
+
+# Campos de cada registro em /api/ml/training-data
+TRAINING_COLUMNS = ["descricao", "valor", "categoria", "tipo", "metodo", "banco", "origem"]
+CATEGORICAL_COLUMNS = ["tipo", "categoria", "metodo", "banco"]
 
 # Bancos conhecidos (mesma lista usada no JS para one-hot encoding)
 BANCOS_CONHECIDOS = [
@@ -61,62 +86,114 @@ BANCOS_CONHECIDOS = [
 # ============================================================
 # Pré-processamento (DEVE ser idêntico ao JS feature-engineering.js)
 # ============================================================
-def normalize_description(text):
-    """Normaliza descrição de transação bancária (espelha JS normalizeDescription)"""
-    if not text:
-        return ""
-
-    # Uppercase + strip
-    normalized = text.upper().strip()
-
-    # Remove acentos
-    normalized = unicodedata.normalize("NFD", normalized)
-    normalized = re.sub(r"[\u0300-\u036f]", "", normalized)
-
-    # Remove números de cartão (4+ dígitos)
-    normalized = re.sub(r"\b\d{4,}\b", "", normalized)
-
-    # Remove datas inline
-    normalized = re.sub(r"\b\d{2}/\d{2}(/\d{2,4})?\b", "", normalized)
-
-    # Normaliza prefixos de gateway
-    normalized = re.sub(r"^DL\*", "GATEWAY*", normalized)
-    normalized = re.sub(r"^MP\s?\*", "GATEWAY*", normalized)
-    normalized = re.sub(r"^PAG\*", "GATEWAY*", normalized)
-    normalized = re.sub(r"^IFD\*", "GATEWAY*", normalized)
-    normalized = re.sub(r"^EC\s?\*", "GATEWAY*", normalized)
-    normalized = re.sub(r"^EBN\*", "GATEWAY*", normalized)
-    normalized = re.sub(r"^PG\s?\*", "GATEWAY*", normalized)
-    normalized = re.sub(r"^PICPAY\*", "PICPAY*", normalized)
-
-    # Espaços extras
-    normalized = re.sub(r"\s+", " ", normalized).strip()
-
-    return normalized
+_RE_DIAC = re.compile(r"[\u0300-\u036f]")
+_RE_CARD = re.compile(r"\b\d{4,}\b")
+_RE_DATE = re.compile(r"\b\d{2}/\d{2}(?:/\d{2,4})?\b")
+_RE_GATEWAY = re.compile(r"^(?:DL|MP\s?|PAG|IFD|EC\s?|EBN|PG\s?)\*")
+_RE_WS = re.compile(r"\s+")
+
+
+def normalize_descriptions(descricoes):
+    """Normaliza descrições de transação bancária (espelha JS normalizeDescription)
+
+    Aplica os passos sobre a Series inteira; cada etapa aqui deve ter a
+    mesma contraparte, na mesma ordem, no normalizeDescription do JS.
+    """
+    return (
+        descricoes.fillna("")
+        .str.upper()
+        .str.strip()
+        .str.normalize("NFD")
+        .str.replace(_RE_DIAC, "", regex=True)
+        .str.replace(_RE_CARD, "", regex=True)
+        .str.replace(_RE_DATE, "", regex=True)
+        .str.replace(_RE_GATEWAY, "GATEWAY*", regex=True)
+        .str.replace(_RE_WS, " ", regex=True)
+        .str.strip()
+    )
 
 
-def encode_banco(banco, bancos_list):
-    """One-hot encode do banco (espelha JS buildFeatureVector)"""
-    banco_norm = unicodedata.normalize("NFD", (banco or "desconhecido").upper())
-    banco_norm = re.sub(r"[\u0300-\u036f]", "", banco_norm)
+def encode_banco(bancos, bancos_list):
+    """One-hot encode vetorizado da coluna banco (espelha JS buildFeatureVector)
+
+    Faz um passe por banco conhecido (K iterações em vez de N), mantendo a
+    semântica do JS: vence o primeiro banco da lista contido no nome
+    normalizado. Retorna CSR (N, K) montada direto dos índices, sem passar
+    por uma matriz densa.
+    """
+    # Com dtype category só os nomes distintos são normalizados e comparados;
+    # as linhas herdam o índice do banco pelos códigos inteiros
+    bancos = bancos.astype("category")
+    nomes_norm = (
+        pd.Series(bancos.cat.categories.astype(str))
+        .str.upper()
+        .str.normalize("NFD")
+        .str.replace(_RE_DIAC, "", regex=True)
+    )
 
-    vec = np.zeros(len(bancos_list), dtype=np.float32)
+    cat_idx = np.full(len(nomes_norm), -1, dtype=np.int32)
     for i, b in enumerate(bancos_list):
-        if b.upper() in banco_norm:
-            vec[i] = 1.0
-            break
-    return vec
+        mask = nomes_norm.str.contains(b.upper(), regex=False).to_numpy() & (cat_idx == -1)
+        cat_idx[mask] = i
+
+    # Código -1 = banco ausente ("desconhecido"), que não casa com nenhum:
+    # o -1 extra no fim da tabela faz codes == -1 cair nele explicitamente
+    # (também quando a coluna é toda nula e não há categorias)
+    codes = bancos.cat.codes.to_numpy()
+    n = len(codes)
+    idx = np.append(cat_idx, -1)[codes]
+
+    matched = idx >= 0
+    data = np.ones(int(matched.sum()), dtype=np.float32)
+    indptr = np.zeros(n + 1, dtype=np.int32)
+    np.cumsum(matched, out=indptr[1:])
+    return csr_matrix((data, idx[matched], indptr), shape=(n, len(bancos_list)))
+
+
+def hash_descriptions(hasher, texts):
+    """Aplica o HashingVectorizer em paralelo, por blocos de linhas
+
+    O hasher é stateless (não há vocabulário a construir), então a
+    tokenização em n-gramas, que é o passo serial mais caro, divide entre
+    processos sem coordenação. Abaixo de HASHING_CHUNK_SIZE linhas por
+    processo o overhead não compensa e roda direto.
+    """
+    n_chunks = min(os.cpu_count() or 1, len(texts) // HASHING_CHUNK_SIZE)
+    if n_chunks <= 1:
+        return hasher.transform(texts)
+
+    parts = Parallel(n_jobs=n_chunks, backend="loky")(
+        delayed(hasher.transform)(chunk) for chunk in np.array_split(texts, n_chunks)
+    )
+    return vstack(parts, format="csr")
+
+
+def column_to_csr(values):
+    """Converte um vetor 1-D em CSR (N, 1) sem alocar intermediário denso"""
+    n = len(values)
+    return csr_matrix(
+        (
+            np.asarray(values, dtype=np.float32),
+            np.zeros(n, dtype=np.int32),
+            np.arange(n + 1, dtype=np.int32),
+        ),
+        shape=(n, 1),
+    )
 
 
 # ============================================================
 # Buscar dados de treino
 # ============================================================
 def fetch_training_data():
-    """Busca dados de treino via API do Next.js"""
+    """Busca dados de treino via API do Next.js
+
+    A resposta é lida em streaming (ijson) direto para o DataFrame, sem
+    materializar o JSON inteiro como objetos Python antes.
+    """
     print(f"Buscando dados de treino em {API_URL}...")
 
     try:
-        resp = requests.get(API_URL, timeout=30)
+        resp = requests.get(API_URL, stream=True, timeout=30)
         resp.raise_for_status()
     except requests.ConnectionError:
         print(f"\nERRO: Não foi possível conectar em {API_URL}")
@@ -126,36 +203,93 @@ def fetch_training_data():
         print(f"\nERRO: API retornou status {e.response.status_code}")
         sys.exit(1)
 
-    data = resp.json()
-    print(f"  Total de registros: {data['total']}")
-    print(f"  Correções manuais: {data['manuais']}")
-    print(f"  Categorias: {len(data['categorias'])}")
+    resp.raw.decode_content = True  # descomprime gzip/deflate no stream
+    with resp:
+        df = pd.DataFrame.from_records(
+            ijson.items(resp.raw, "dados.item", use_float=True),
+            columns=TRAINING_COLUMNS
+        )
 
-    return data["dados"]
+    return df
+
+
+def load_training_data():
+    """Retorna os dados de treino do cache local (se recente) ou da API
+
+    O cache evita repetir HTTP + parse do JSON em re-execuções próximas
+    (ajuste de hiperparâmetros, re-export). TRAINING_CACHE_TTL=0 desativa.
+    """
+    url_hash = hashlib.sha1(API_URL.encode("utf-8")).hexdigest()[:8]
+    cache_path = os.path.join(CACHE_DIR, f"training_data_{url_hash}.parquet")
+
+    if CACHE_TTL_SECONDS > 0 and os.path.exists(cache_path):
+        age = time.time() - os.path.getmtime(cache_path)
+        if age < CACHE_TTL_SECONDS:
+            try:
+                df = pd.read_parquet(cache_path)
+            except (OSError, ValueError) as e:
+                # Cache truncado ou corrompido vale como miss
+                print(f"AVISO: cache de dados de treino ilegível, buscando na API ({e})")
+            else:
+                print(f"Usando cache de dados de treino ({age / 60:.0f} min): {cache_path}")
+                print_training_summary(df)
+                return df
+
+    df = fetch_training_data()
+
+    if CACHE_TTL_SECONDS > 0:
+        # Escreve em arquivo temporário e troca atomicamente: uma execução
+        # interrompida no meio não deixa um parquet truncado com mtime novo
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, cache_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    print_training_summary(df)
+    return df
+
+
+def print_training_summary(df):
+    """Resumo dos dados de treino, igual para cache e API"""
+    print(f"  Total de registros: {len(df)}")
+    print(f"  Correções manuais: {int((df['metodo'] == 'manual').sum())}")
+    print(f"  Categorias: {len(df.groupby(['tipo', 'categoria']))}")
 
 
 # ============================================================
 # Preparar dataset
 # ============================================================
-def prepare_dataset(dados):
-    """Converte dados brutos em DataFrame com features processadas"""
-    df = pd.DataFrame(dados)
+def prepare_dataset(df):
+    """Processa o DataFrame bruto da API em features de treino"""
+    # Colunas de baixa cardinalidade como category: comparações, groupby e
+    # o encode do banco passam a operar nos códigos inteiros
+    df = df.astype({col: "category" for col in CATEGORICAL_COLUMNS})  # cópia, não altera o chamador
 
     # Normalizar descrições
-    df["descricao_norm"] = df["descricao"].apply(normalize_description)
+    df["descricao_norm"] = normalize_descriptions(df["descricao"])
 
     # Remover linhas sem descrição ou categoria
     df = df[df["descricao_norm"].str.len() > 0]
     df = df[df["categoria"].notna() & (df["categoria"] != "")]
 
+    # Índice contíguo 0..N-1: o índice do DataFrame passa a ser a posição
+    # da linha em X_full (usado para fatiar a matriz por estágio)
+    df = df.reset_index(drop=True)
+
     # Normalizar tipo para PJ/PF
-    df["tipo"] = df["tipo"].apply(lambda x: x if x in ("PJ", "PF") else "PJ")
+    df["tipo"] = df["tipo"].cat.set_categories(["PJ", "PF"]).fillna("PJ")
 
     # Peso: manual = 3, automático = 1
-    df["sample_weight"] = df["metodo"].apply(lambda m: 3.0 if m == "manual" else 1.0)
+    metodo = df["metodo"].cat
+    manual_code = metodo.categories.get_loc("manual") if "manual" in metodo.categories else -2
+    df["sample_weight"] = np.where(metodo.codes.to_numpy() == manual_code, 3.0, 1.0).astype(np.float32)
 
     # Log(valor)
-    df["log_valor"] = np.log1p(df["valor"].abs())
+    df["log_valor"] = np.log1p(np.abs(df["valor"].to_numpy(dtype=np.float64))).astype(np.float32)
 
     print(f"\n  Dataset preparado: {len(df)} registros")
     print(f"  PJ: {(df['tipo'] == 'PJ').sum()}, PF: {(df['tipo'] == 'PF').sum()}")
@@ -168,7 +302,7 @@ def prepare_dataset(dados):
 # ============================================================
 def filter_rare_categories(df, tipo_col, cat_col, min_samples):
     """Remove categorias com menos de min_samples exemplos"""
-    counts = df.groupby(cat_col).size()
+    counts = df.groupby(cat_col, observed=True).size()
     valid_cats = counts[counts >= min_samples].index
     removed = counts[counts < min_samples]
 
@@ -180,6 +314,28 @@ def filter_rare_categories(df, tipo_col, cat_col, min_samples):
     return df[df[cat_col].isin(valid_cats)]
 
 
+# ============================================================
+# Split treino/teste
+# ============================================================
+def stratified_split(X, y, weights):
+    """Split estratificado treino/teste por índices de linha
+
+    Mesma partição do train_test_split(stratify=y) com o mesmo
+    random_state, mas os índices são ordenados antes do gather: cada
+    fatia da CSR vira uma cópia sequencial, feita uma vez só para X, y e w.
+    """
+    sss = StratifiedShuffleSplit(n_splits=1, test_size=TEST_SIZE, random_state=RANDOM_STATE)
+    train_idx, test_idx = next(sss.split(np.zeros(len(y)), y))
+    train_idx.sort()
+    test_idx.sort()
+
+    return (
+        X[train_idx], X[test_idx],
+        y[train_idx], y[test_idx],
+        weights[train_idx], weights[test_idx]
+    )
+
+
 # ============================================================
 # Treinar um modelo
 # ============================================================
@@ -220,35 +376,119 @@ def train_model(X_train, y_train, weights_train, X_test, y_test, model_name):
     return clf, accuracy, report
 
 
+def fit_stage(X, df_stage, model_name):
+    """Split estratificado + treino de um estágio (roda em processo separado)
+
+    A saída do treino (stdout e avisos do sklearn em stderr) é capturada e
+    devolvida para o processo principal imprimir em ordem, sem intercalar os
+    logs dos estágios paralelos.
+    """
+    X.sort_indices()  # no-op se o row-gather já preservou a ordenação
+
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        y = df_stage["categoria"].to_numpy()
+        w = df_stage["sample_weight"].values
+
+        X_tr, X_te, y_tr, y_te, w_tr, _ = stratified_split(X, y, w)
+
+        clf, accuracy, report = train_model(
+            X_tr, y_tr, w_tr,
+            X_te, y_te,
+            model_name
+        )
+
+    return clf, accuracy, report, log.getvalue()
+
+
 # ============================================================
 # Exportar para ONNX
 # ============================================================
-def export_to_onnx(model, n_features, output_path, model_name):
-    """Exporta sklearn model para ONNX"""
+def validate_onnx(path, model, X_sample):
+    """Roda X_sample no modelo ONNX e compara com o sklearn
+
+    Retorna (concordância de labels, maior diferença de probabilidade, shape).
+    """
+    # Um único run em lote amortiza o overhead por chamada
+    sess_opt = ort.SessionOptions()
+    sess_opt.intra_op_num_threads = os.cpu_count() or 1
+    sess_opt.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    sess = ort.InferenceSession(path, sess_opt)
+
+    test_input = X_sample.toarray().astype(np.float32)
+    result = sess.run(None, {"float_input": test_input})
+    agreement = np.mean(model.classes_[result[0]] == model.predict(X_sample))
+    max_prob_diff = float(np.abs(result[1] - model.predict_proba(X_sample)).max())
+    return agreement, max_prob_diff, result[0].shape
+
+
+def export_to_onnx(model, X_sample, output_path, model_name):
+    """Exporta sklearn model para ONNX e valida contra o sklearn em X_sample"""
+    n_features = X_sample.shape[1]
     initial_type = [("float_input", FloatTensorType([None, n_features]))]
 
+    # Sem ZipMap: 'probabilities' sai como tensor [N, C] em vez de lista de
+    # dicts, e 'label' como índice da classe (os nomes ficam em label_maps.json)
     onnx_model = convert_sklearn(
         model,
         model_name,
         initial_types=initial_type,
-        target_opset=15
+        target_opset=15,
+        options={id(model): {"zipmap": False, "nocl": True}}
     )
 
+    if onnxoptimizer is not None:
+        onnx_model = onnxoptimizer.optimize(onnx_model, ONNX_OPTIMIZER_PASSES)
+
     with open(output_path, "wb") as f:
         f.write(onnx_model.SerializeToString())
 
     size_kb = os.path.getsize(output_path) / 1024
     print(f"  Exportado: {output_path} ({size_kb:.1f} KB)")
 
-    # Validar ONNX
-    sess = ort.InferenceSession(output_path)
-    test_input = np.random.randn(1, n_features).astype(np.float32)
-    result = sess.run(None, {"float_input": test_input})
-    print(f"  Validação ONNX OK (output shape: {result[0].shape})")
+    # Labels e probabilidades precisam bater: a "confianca" é comparada com
+    # limiares no app
+    agreement, prob_diff, output_shape = validate_onnx(output_path, model, X_sample)
+    detalhes = f"output shape: {output_shape}, concordância sklearn: {agreement:.2%}, Δprob máx: {prob_diff:.4f}"
+    if agreement >= ONNX_MIN_AGREEMENT and prob_diff <= ONNX_MAX_PROB_DIFF:
+        print(f"  Validação ONNX OK ({detalhes})")
+    else:
+        print(f"  AVISO: modelo ONNX diverge do sklearn ({detalhes})")
 
     return True
 
 
+# ============================================================
+# Exportar pesos lineares (inferência esparsa no JS)
+# ============================================================
+def export_linear_weights(model, output_dir, model_name):
+    """Exporta coef_/intercept_ para o JS fazer o produto esparso direto
+
+    Os pesos vão em float32 little-endian no layout (n_features, n_outputs),
+    para que cada coluna não-nula da entrada leia seus pesos contíguos.
+    Retorna os metadados para linear_models.json.
+    """
+    coef = model.coef_.astype(np.float32)
+    weights_file = f"{model_name}.coef.f32"
+
+    with open(os.path.join(output_dir, weights_file), "wb") as f:
+        f.write(np.ascontiguousarray(coef.T).astype("<f4").tobytes())
+
+    print(f"  Pesos lineares: {weights_file} ({coef.nbytes / 1024:.1f} KB)")
+
+    return {
+        "weights_file": weights_file,
+        "n_features": coef.shape[1],
+        "n_outputs": coef.shape[0],
+        "intercept": model.intercept_.astype(float).tolist(),
+        # Binário: coef_ tem 1 linha (classe positiva = classes_[1]).
+        # Multi-classe: o SGDClassifier é one-vs-rest, o predict_proba aplica
+        # a sigmoide em cada score e normaliza pela soma (não é softmax)
+        "link": "logistic" if coef.shape[0] == 1 else "ovr",
+        "classes": model.classes_.tolist()
+    }
+
+
 # ============================================================
 # Pipeline principal
 # ============================================================
@@ -258,8 +498,12 @@ def main():
     print(f"Data: {datetime.now().strftime('%Y-%m-%d %H:%M')}")
     print("=" * 60)
 
+    if EXPORT_ONNX and convert_sklearn is None:
+        print("ERRO: skl2onnx não instalado. Execute: pip install skl2onnx")
+        sys.exit(1)
+
     # 1. Buscar dados
-    dados = fetch_training_data()
+    dados = load_training_data()
 
     if len(dados) < MIN_TOTAL_SAMPLES:
         print(f"\nERRO: Poucos dados para treino ({len(dados)} < {MIN_TOTAL_SAMPLES})")
@@ -269,41 +513,55 @@ def main():
     # 2. Preparar dataset
     df = prepare_dataset(dados)
 
-    # 3. TF-IDF Vectorizer (character n-grams)
-    print("\nFitando TF-IDF vectorizer...")
-    tfidf = TfidfVectorizer(
+    # 3. TF-IDF sobre n-gramas de caracteres com hashing trick (sem passe de
+    # construção de vocabulário; o JS reproduz o hash MurmurHash3)
+    print("\nAplicando HashingVectorizer + TF-IDF...")
+    hasher = HashingVectorizer(
         analyzer="char_wb",
-        ngram_range=(2, 4),
-        max_features=TFIDF_MAX_FEATURES,
+        ngram_range=NGRAM_RANGE,
+        n_features=HASHING_N_FEATURES,
+        alternate_sign=False,
+        norm=None,  # a normalização L2 fica no TfidfTransformer
         lowercase=False,  # já normalizamos manualmente
-        strip_accents=None  # já removemos acentos
+        dtype=np.float32  # o ONNX usa FloatTensorType, float64 só dobra a memória
     )
-    tfidf_matrix = tfidf.fit_transform(df["descricao_norm"])
-    print(f"  Vocabulário: {len(tfidf.vocabulary_)} termos")
+    tfidf = TfidfTransformer()
+    # Fit/transform só nas descrições distintas (comerciantes recorrentes se
+    # repetem muito) e expande de volta para as N linhas via row-gather
+    unique_desc, inverse = np.unique(df["descricao_norm"].to_numpy(), return_inverse=True)
+    tfidf_matrix = tfidf.fit_transform(hash_descriptions(hasher, unique_desc))[inverse]
+    print(f"  Descrições distintas: {len(unique_desc)} de {len(df)}")
+    print(f"  Espaço de hashing: {HASHING_N_FEATURES} features")
 
     # 4. Features adicionais: banco (one-hot) + log(valor)
-    banco_features = np.array([
-        encode_banco(b, BANCOS_CONHECIDOS) for b in df["banco"]
-    ])
-    valor_features = df["log_valor"].values.reshape(-1, 1).astype(np.float32)
+    banco_features = encode_banco(df["banco"], BANCOS_CONHECIDOS)
+    valor_features = column_to_csr(df["log_valor"].to_numpy())
 
     # Combinar features
     X_full = hstack([
         tfidf_matrix,
-        csr_matrix(banco_features),
-        csr_matrix(valor_features)
-    ])
+        banco_features,
+        valor_features
+    ], format="csr", dtype=np.float32)
+    # Índices de coluna ordenados e sem duplicatas por linha: habilita o
+    # caminho rápido (varredura contígua) nos produtos esparsos do solver
+    X_full.sum_duplicates()
+    X_full.sort_indices()
 
     n_features = X_full.shape[1]
     print(f"  Features totais: {n_features} (TF-IDF: {tfidf_matrix.shape[1]}, banco: {banco_features.shape[1]}, valor: 1)")
 
     # 5. Salvar vocabulário para o JS
     vocabulary_data = {
-        "terms": tfidf.get_feature_names_out().tolist(),
-        "idf": tfidf.idf_.tolist(),
+        "hashing": {
+            "analyzer": "char_wb",
+            "ngram_range": list(NGRAM_RANGE),
+            "n_features": HASHING_N_FEATURES
+        },
+        "idf_file": IDF_FILENAME,
         "bancos": BANCOS_CONHECIDOS,
         "n_features": n_features,
-        "tfidf_size": len(tfidf.vocabulary_),
+        "tfidf_size": HASHING_N_FEATURES,
         "banco_size": len(BANCOS_CONHECIDOS),
         "numeric_size": 1
     }
@@ -312,7 +570,13 @@ def main():
     vocab_path = os.path.join(OUTPUT_DIR, "vocabulary.json")
     with open(vocab_path, "w", encoding="utf-8") as f:
         json.dump(vocabulary_data, f, ensure_ascii=False)
-    print(f"  Vocabulário salvo: {vocab_path}")
+
+    # IDF em binário (float32 little-endian): 4 bytes por termo e sem
+    # re-parse de floats em JSON no cold start do JS
+    idf_path = os.path.join(OUTPUT_DIR, IDF_FILENAME)
+    with open(idf_path, "wb") as f:
+        f.write(tfidf.idf_.astype("<f4").tobytes())
+    print(f"  Vocabulário salvo: {vocab_path} (+ {IDF_FILENAME})")
 
     # ========================================================
     # MODELO 1: Classificador PJ vs PF (tipo)
@@ -320,15 +584,10 @@ def main():
     print("\n" + "=" * 60)
     print("ESTÁGIO 1: Classificador PJ vs PF")
 
-    y_tipo = df["tipo"].values
+    y_tipo = df["tipo"].to_numpy()
     weights = df["sample_weight"].values
 
-    X_train, X_test, y_train, y_test, w_train, w_test = train_test_split(
-        X_full, y_tipo, weights,
-        test_size=TEST_SIZE,
-        stratify=y_tipo,
-        random_state=RANDOM_STATE
-    )
+    X_train, X_test, y_train, y_test, w_train, w_test = stratified_split(X_full, y_tipo, weights)
 
     clf_tipo, acc_tipo, report_tipo = train_model(
         X_train, y_train, w_train,
@@ -337,105 +596,87 @@ def main():
     )
 
     # ========================================================
-    # MODELO 2: Classificador de categorias PJ
+    # MODELOS 2 e 3: Classificadores de categorias PJ e PF
     # ========================================================
-    print("\n" + "=" * 60)
-    print("ESTÁGIO 2a: Classificador categorias PJ")
-
-    df_pj = df[df["tipo"] == "PJ"].copy()
-    df_pj = filter_rare_categories(df_pj, "tipo", "categoria", MIN_SAMPLES_PER_CLASS)
-
-    acc_pj = 0
-    report_pj = {}
-    clf_pj = None
-    pj_labels = []
-
-    if len(df_pj) >= 10:
-        X_pj = X_full[df_pj.index]
-        y_pj = df_pj["categoria"].values
-        w_pj = df_pj["sample_weight"].values
-        pj_labels = sorted(df_pj["categoria"].unique().tolist())
-
-        if len(pj_labels) >= 2:
-            X_tr, X_te, y_tr, y_te, w_tr, _ = train_test_split(
-                X_pj, y_pj, w_pj,
-                test_size=TEST_SIZE,
-                stratify=y_pj,
-                random_state=RANDOM_STATE
-            )
-
-            clf_pj, acc_pj, report_pj = train_model(
-                X_tr, y_tr, w_tr,
-                X_te, y_te,
-                "categorizer_pj"
-            )
+    # Os dois estágios são independentes (subconjuntos disjuntos de linhas),
+    # então a seleção de dados roda aqui e os fits rodam em paralelo.
+    stages = {}
+    jobs = []
+
+    for stage_id, tipo in (("2a", "PJ"), ("2b", "PF")):
+        key = tipo.lower()
+        print("\n" + "=" * 60)
+        print(f"ESTÁGIO {stage_id}: Classificador categorias {tipo}")
+
+        df_stage = df[df["tipo"] == tipo].copy()
+        df_stage = filter_rare_categories(df_stage, "tipo", "categoria", MIN_SAMPLES_PER_CLASS)
+        labels = sorted(df_stage["categoria"].unique().tolist())
+
+        stages[key] = {"df": df_stage, "labels": [], "clf": None, "acc": 0, "report": {}}
+
+        if len(df_stage) < 10:
+            print(f"  SKIP: Poucos dados {tipo} ({len(df_stage)} registros)")
+        elif len(labels) < 2:
+            print(f"  SKIP: Apenas 1 categoria {tipo}. Modelo não treinado.")
         else:
-            print("  SKIP: Apenas 1 categoria PJ. Modelo não treinado.")
-    else:
-        print(f"  SKIP: Poucos dados PJ ({len(df_pj)} registros)")
+            stages[key]["labels"] = labels
+            # Um único row-gather por estágio, com índices posicionais ordenados
+            rows = df_stage.index.to_numpy()
+            jobs.append((key, X_full[rows], df_stage))
+
+    results = Parallel(n_jobs=2, backend="loky")(
+        delayed(fit_stage)(X_stage, df_stage, f"categorizer_{key}")
+        for key, X_stage, df_stage in jobs
+    )
 
-    # ========================================================
-    # MODELO 3: Classificador de categorias PF
-    # ========================================================
-    print("\n" + "=" * 60)
-    print("ESTÁGIO 2b: Classificador categorias PF")
-
-    df_pf = df[df["tipo"] == "PF"].copy()
-    df_pf = filter_rare_categories(df_pf, "tipo", "categoria", MIN_SAMPLES_PER_CLASS)
-
-    acc_pf = 0
-    report_pf = {}
-    clf_pf = None
-    pf_labels = []
-
-    if len(df_pf) >= 10:
-        X_pf = X_full[df_pf.index]
-        y_pf = df_pf["categoria"].values
-        w_pf = df_pf["sample_weight"].values
-        pf_labels = sorted(df_pf["categoria"].unique().tolist())
-
-        if len(pf_labels) >= 2:
-            X_tr, X_te, y_tr, y_te, w_tr, _ = train_test_split(
-                X_pf, y_pf, w_pf,
-                test_size=TEST_SIZE,
-                stratify=y_pf,
-                random_state=RANDOM_STATE
-            )
-
-            clf_pf, acc_pf, report_pf = train_model(
-                X_tr, y_tr, w_tr,
-                X_te, y_te,
-                "categorizer_pf"
-            )
-        else:
-            print("  SKIP: Apenas 1 categoria PF. Modelo não treinado.")
-    else:
-        print(f"  SKIP: Poucos dados PF ({len(df_pf)} registros)")
+    for (key, _, _), (clf, acc, report, log) in zip(jobs, results):
+        print(log, end="")
+        stages[key].update(clf=clf, acc=acc, report=report)
+
+    df_pj, pj_labels = stages["pj"]["df"], stages["pj"]["labels"]
+    clf_pj, acc_pj, report_pj = stages["pj"]["clf"], stages["pj"]["acc"], stages["pj"]["report"]
+    df_pf, pf_labels = stages["pf"]["df"], stages["pf"]["labels"]
+    clf_pf, acc_pf, report_pf = stages["pf"]["clf"], stages["pf"]["acc"], stages["pf"]["report"]
 
     # ========================================================
-    # Exportar modelos ONNX
+    # Exportar pesos lineares (artefato canônico do app)
     # ========================================================
     print("\n" + "=" * 60)
-    print("Exportando modelos ONNX...")
+    print("Exportando pesos lineares...")
 
     exported = []
+    linear_models = {}
+    for key, clf in (("tipo", clf_tipo), ("pj", clf_pj), ("pf", clf_pf)):
+        if clf is not None:
+            linear_models[key] = export_linear_weights(clf, OUTPUT_DIR, f"categorizer_{key}")
+            exported.append(linear_models[key]["weights_file"])
 
-    # Tipo
-    tipo_path = os.path.join(OUTPUT_DIR, "categorizer_tipo.onnx")
-    if export_to_onnx(clf_tipo, n_features, tipo_path, "categorizer_tipo"):
-        exported.append("categorizer_tipo.onnx")
+    linear_path = os.path.join(OUTPUT_DIR, "linear_models.json")
+    with open(linear_path, "w", encoding="utf-8") as f:
+        json.dump(linear_models, f, ensure_ascii=False, indent=2)
 
-    # PJ
-    if clf_pj is not None:
-        pj_path = os.path.join(OUTPUT_DIR, "categorizer_pj.onnx")
-        if export_to_onnx(clf_pj, n_features, pj_path, "categorizer_pj"):
-            exported.append("categorizer_pj.onnx")
-
-    # PF
-    if clf_pf is not None:
-        pf_path = os.path.join(OUTPUT_DIR, "categorizer_pf.onnx")
-        if export_to_onnx(clf_pf, n_features, pf_path, "categorizer_pf"):
-            exported.append("categorizer_pf.onnx")
+    # ========================================================
+    # Exportar modelos ONNX (opcional, fallback legado)
+    # ========================================================
+    # O JS só carrega os .onnx quando não há linear_models.json, então por
+    # padrão eles não são gerados, e os de treinos anteriores são removidos
+    # para não ficarem dessincronizados do vocabulário novo.
+    # Cada modelo é validado com linhas do seu próprio domínio (tipo: todas,
+    # PJ/PF: só as do estágio) para a concordância refletir o uso real
+    onnx_stages = (("tipo", clf_tipo, df.index), ("pj", clf_pj, df_pj.index), ("pf", clf_pf, df_pf.index))
+
+    if EXPORT_ONNX:
+        print("\nExportando modelos ONNX (TRAINING_EXPORT_ONNX=1)...")
+        for key, clf, rows in onnx_stages:
+            onnx_path = os.path.join(OUTPUT_DIR, f"categorizer_{key}.onnx")
+            if clf is not None and export_to_onnx(clf, X_full[rows[:ONNX_VALIDATION_ROWS]], onnx_path, f"categorizer_{key}"):
+                exported.append(f"categorizer_{key}.onnx")
+    else:
+        for key, _, _ in onnx_stages:
+            stale_path = os.path.join(OUTPUT_DIR, f"categorizer_{key}.onnx")
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+                print(f"  Removido ONNX antigo: categorizer_{key}.onnx")
 
     # ========================================================
     # Salvar label maps
@@ -482,11 +723,12 @@ def main():
             }
         },
         "feature_config": {
-            "tfidf_max_features": TFIDF_MAX_FEATURES,
-            "ngram_range": [2, 4],
+            "hashing_n_features": HASHING_N_FEATURES,
+            "ngram_range": list(NGRAM_RANGE),
             "n_features_total": n_features,
             "bancos": BANCOS_CONHECIDOS
         },
+        "engine": "linear",
         "exported_files": exported
     }
 
@@ -507,6 +749,8 @@ def main():
     if clf_pf:
         print(f"  Categorias PF: accuracy={acc_pf:.4f} ({len(pf_labels)} classes)")
     print(f"  Modelos exportados: {', '.join(exported)}")
+    print("  Motor de inferência no app: linear (linear_models.json)"
+          + (", ONNX exportado só como fallback legado" if EXPORT_ONNX else ""))
     print(f"  Diretório: {OUTPUT_DIR}")
     print(f"\nRelatório salvo: {report_path}")
     print("\nPróximo passo: faça deploy ou rode 'npm run dev' para usar os modelos.")